@@ -6,54 +6,96 @@ This script reads an exported Langfuse trace JSON file and creates a new trace
 in Langfuse with the same structure and data using the Public API.
 """
 
-import json
 import argparse
 import sys
 from datetime import datetime
-from typing import List, Dict, Any
-import uuid
+from typing import List, Dict, Any, Iterator
 import os
+import gzip
+import re
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # --- LOAD .env ---
 load_dotenv()
 
+# Ingestion events are sent in chunks of this size, several chunks at a time
+BATCH_CHUNK_SIZE = 256
+MAX_WORKERS = 8
+
+# Ingestion event type for each observation type; anything else is sent as a span
+EVENT_TYPES = {
+    'GENERATION': "generation-create",
+    'SPAN': "span-create",
+    'EVENT': "event-create",
+}
+
+# Shared keep-alive session so every POST reuses pooled connections
+SESSION = requests.Session()
+SESSION.headers.update({"Content-Type": "application/json", "Accept-Encoding": "gzip"})
+_adapter = HTTPAdapter(
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+)
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+
 
 def load_trace_file(filepath: str) -> List[Dict[str, Any]]:
-    encodings = ['utf-8', 'utf-8-sig', 'latin-1', 'cp1252']
+    try:
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+    except FileNotFoundError:
+        print(f"Error: File '{filepath}' not found")
+        sys.exit(1)
+    
+    # JSON is UTF-8, so parse the bytes directly and only try other encodings on failure
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        error = e
     
-    for encoding in encodings:
+    for encoding in ['utf-8-sig', 'latin-1', 'cp1252']:
         try:
-            with open(filepath, 'r', encoding=encoding) as f:
-                data = json.load(f)
-            if encoding != 'utf-8':
-                print(f"Note: File was read using {encoding} encoding")
-            return data
-        except UnicodeDecodeError:
+            data = orjson.loads(raw.decode(encoding))
+        except (UnicodeDecodeError, orjson.JSONDecodeError):
             continue
-        except FileNotFoundError:
-            print(f"Error: File '{filepath}' not found")
-            sys.exit(1)
-        except json.JSONDecodeError as e:
-            print(f"Error: Invalid JSON in file: {e}")
-            sys.exit(1)
-    
-    print("Error: Could not decode file with any common encoding")
+        print(f"Note: File was read using {encoding} encoding")
+        return data
+    
+    print(f"Error: Invalid JSON in file: {error}")
     sys.exit(1)
 
 
+@lru_cache(maxsize=1024)
+def _parse_json_string(value: str) -> Any:
+    # Repeated strings (e.g. shared tool definitions) share one parsed result,
+    # so callers must not mutate what comes back
+    try:
+        parsed = orjson.loads(value)
+    except orjson.JSONDecodeError:
+        # Not valid JSON, return as-is
+        return value
+    # Recursively parse nested structures
+    return parse_json_if_string(parsed)
+
+
 def parse_json_if_string(value: Any) -> Any:
     """Parse JSON strings into objects, preserving structure"""
     if isinstance(value, str):
-        try:
-            parsed = json.loads(value)
-            # Recursively parse nested structures
-            return parse_json_if_string(parsed)
-        except (json.JSONDecodeError, ValueError):
-            # Not valid JSON, return as-is
-            return value
+        return _parse_json_string(value)
     elif isinstance(value, dict):
         return {k: parse_json_if_string(v) for k, v in value.items()}
     elif isinstance(value, list):
@@ -77,27 +119,30 @@ def transform_tool_calls_output(output_data: Any) -> Any:
             
             for tool_call in tool_calls_list:
                 if isinstance(tool_call, dict):
-                    # Create the nested structure expected by Langfuse
-                    transformed_call = {
-                        "toolCall": {
-                            "id": tool_call.get("id", ""),
-                            "name": tool_call.get("function", {}).get("name", "") if "function" in tool_call else tool_call.get("name", ""),
-                            "input": {}
-                        }
-                    }
-                    
+                    # Look up the function entry once and read its fields directly
+                    function = tool_call.get("function")
+                    has_function = isinstance(function, dict)
+                    tool_input = {}
+
                     # Parse the arguments if present
-                    if "function" in tool_call and "arguments" in tool_call["function"]:
-                        args = tool_call["function"]["arguments"]
+                    if has_function and "arguments" in function:
+                        args = function["arguments"]
                         if isinstance(args, str):
                             try:
-                                transformed_call["toolCall"]["input"] = json.loads(args)
-                            except:
-                                transformed_call["toolCall"]["input"] = {}
+                                tool_input = orjson.loads(args)
+                            except orjson.JSONDecodeError:
+                                tool_input = {}
                         elif isinstance(args, dict):
-                            transformed_call["toolCall"]["input"] = args
-                    
-                    transformed["toolCalls"].append(transformed_call)
+                            tool_input = args
+
+                    # Create the nested structure expected by Langfuse
+                    transformed["toolCalls"].append({
+                        "toolCall": {
+                            "id": tool_call.get("id", ""),
+                            "name": function.get("name", "") if has_function else tool_call.get("name", ""),
+                            "input": tool_input
+                        }
+                    })
             
             # Add content and contents fields
             transformed["content"] = " "
@@ -108,78 +153,213 @@ def transform_tool_calls_output(output_data: Any) -> Any:
     return output_data
 
 
+# camelCase tool call keys and their snake_case replacements
+TOOL_CALL_KEYS = {
+    "toolCallId": "tool_call_id",
+    "toolCalls": "tool_calls",
+    "toolCall": "tool_call",
+}
+TOOL_CALL_PATTERN = re.compile(r"toolCall(?:Id|s)?")
+
+
 def normalize_tool_call_keys(value: Any) -> Any:
     """Recursively convert camelCase tool call keys to snake_case"""
     if isinstance(value, str):
-        # For string values, replace the camelCase patterns
-        return (
-            value
-            .replace("toolCallId", "tool_call_id")
-            .replace("toolCalls", "tool_calls")
-            .replace("toolCall", "tool_call")
-        )
+        if "toolCall" not in value:
+            return value
+    elif isinstance(value, (dict, list)):
+        # Most payloads contain no tool calls; one serialized scan lets us skip the rebuild
+        try:
+            if b"toolCall" not in orjson.dumps(value):
+                return value
+        except orjson.JSONEncodeError:
+            pass
+    return _normalize_tool_call_keys(value)
+
+
+def _normalize_tool_call_keys(value: Any) -> Any:
+    if isinstance(value, str):
+        # For string values, replace the camelCase patterns in a single scan
+        return TOOL_CALL_PATTERN.sub(lambda m: TOOL_CALL_KEYS[m[0]], value)
     elif isinstance(value, dict):
-        result = {}
-        for k, v in value.items():
-            # Convert the key itself
-            new_key = k
-            if k == "toolCallId":
-                new_key = "tool_call_id"
-            elif k == "toolCalls":
-                new_key = "tool_calls"
-            elif k == "toolCall":
-                new_key = "tool_call"
-            
-            # Recursively process the value
-            result[new_key] = normalize_tool_call_keys(v)
-        return result
+        # Convert the keys themselves and recursively process the values
+        return {TOOL_CALL_KEYS.get(k, k): _normalize_tool_call_keys(v) for k, v in value.items()}
     elif isinstance(value, list):
-        return [normalize_tool_call_keys(v) for v in value]
+        return [_normalize_tool_call_keys(v) for v in value]
     return value
 
 
-def deep_merge(a: Any, b: Any) -> Any:
-    """Recursively merge b into a"""
+def deep_merge_inplace(a: Any, b: Any) -> Any:
+    """Recursively merge b into a, mutating a (and any subtrees it took from earlier merges)"""
     if isinstance(a, Mapping) and isinstance(b, Mapping):
-        result = dict(a)
         for k, v in b.items():
-            if k in result:
-                result[k] = deep_merge(result[k], v)
+            if k in a:
+                a[k] = deep_merge_inplace(a[k], v)
             else:
-                result[k] = v
-        return result
+                a[k] = v
+        return a
     if isinstance(a, list) and isinstance(b, list):
-        return a + b
+        a.extend(b)
+        return a
     return b  # fallback: overwrite
 
 
-def collect_trace_io(observations: List[Dict[str, Any]]) -> (Any, Any):
-    """Get the input and output from the last chat-completion observation"""
-    final_input = None
-    final_output = None
+def prepare_observation(obs: Dict[str, Any]) -> None:
+    """Parse and normalize input/output/metadata once, caching them on the observation"""
+    if obs.get('input') is not None:
+        input_data = parse_json_if_string(obs['input'])
+        obs['_input'] = normalize_tool_call_keys(input_data)
     
-    # Find the last chat-completion observation (skip tool-call and tool-start-message)
-    for obs in reversed(observations):
-        obs_name = obs.get('name', '')
-        
-        # Skip tool-call and tool-start-message observations
-        if 'tool-call' in obs_name or 'tool-start-message' in obs_name:
-            continue
-            
-        # Look for chat-completion observations
-        if 'chat-completion' in obs_name:
-            if obs.get('input') is not None:
-                input_data = parse_json_if_string(obs['input'])
-                final_input = normalize_tool_call_keys(input_data)
-            
-            if obs.get('output') is not None:
-                output_data = parse_json_if_string(obs['output'])
-                output_data = transform_tool_calls_output(output_data)
-                final_output = normalize_tool_call_keys(output_data)
-            
-            break
+    if obs.get('output') is not None:
+        output_data = parse_json_if_string(obs['output'])
+        # Transform tool_calls format if present
+        output_data = transform_tool_calls_output(output_data)
+        obs['_output'] = normalize_tool_call_keys(output_data)
+    
+    # Only non-empty dict metadata is worth normalizing; anything else is sent as {}
+    metadata = obs.get("metadata")
+    if isinstance(metadata, dict):
+        obs['_metadata'] = normalize_tool_call_keys(metadata) if metadata else metadata
+    else:
+        obs['_metadata'] = {}
+
+
+def is_trace_io_source(obs: Dict[str, Any]) -> bool:
+    """Whether the observation is a chat-completion whose input/output can represent the trace"""
+    obs_name = obs.get('name', '')
+    
+    # Skip tool-call and tool-start-message observations
+    if 'tool-call' in obs_name or 'tool-start-message' in obs_name:
+        return False
+    
+    return 'chat-completion' in obs_name
+
+
+def chunks(items: List[Any], size: int) -> List[List[Any]]:
+    """Split items into consecutive lists of at most size elements"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def post_batch(
+    api_url: str,
+    events: List[Dict[str, Any]],
+    auth: tuple,
+    compress: bool = False
+) -> requests.Response:
+    """Send one chunk of ingestion events to Langfuse"""
+    payload = {
+        "batch": events,
+        "metadata": {
+            "batch_size": len(events),
+            "sdk_integration": "trace_importer",
+            "sdk_name": "python",
+            "sdk_version": "custom"
+        }
+    }
     
-    return final_input, final_output
+    body = orjson.dumps(payload)
+    headers = {}
+    if compress:
+        body = gzip.compress(body, compresslevel=3)
+        headers["Content-Encoding"] = "gzip"
+    
+    return SESSION.post(
+        api_url,
+        data=body,
+        headers=headers,
+        auth=auth,
+        timeout=30
+    )
+
+
+def post_events(
+    api_url: str,
+    events: List[Dict[str, Any]],
+    auth: tuple,
+    compress: bool = False
+) -> List[requests.Response]:
+    """Send events in chunks, overlapping the round trips over the shared session"""
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [
+            pool.submit(post_batch, api_url, batch, auth, compress)
+            for batch in chunks(events, BATCH_CHUNK_SIZE)
+        ]
+        return [future.result() for future in futures]
+
+
+def generate_ids(count: int) -> List[str]:
+    """Random 32-character hex IDs, drawn from a single urandom read"""
+    rnd = os.urandom(16 * count).hex()
+    return [rnd[i:i + 32] for i in range(0, 32 * count, 32)]
+
+
+def build_event(
+    obs: Dict[str, Any],
+    trace_id: str,
+    generate_new_ids: bool,
+    id_mapping: Dict[str, str],
+    now_iso: str,
+    ids: Iterator[str]
+) -> Dict[str, Any]:
+    """Build the ingestion event for one prepared observation"""
+    obs_id = obs.get('id')
+    obs_type = obs.get('type', 'SPAN')
+    start_time = obs.get('startTime')
+    end_time = obs.get('endTime')
+    
+    if generate_new_ids:
+        new_id = next(ids)
+        id_mapping[obs_id] = new_id
+        obs_id = new_id
+    
+    parent_id = obs.get('parentObservationId')
+    if parent_id and generate_new_ids:
+        parent_id = id_mapping.get(parent_id)
+    
+    obs_kind = obs_type.upper()
+    event_type = EVENT_TYPES.get(obs_kind, "span-create")
+    
+    body = {
+        "id": obs_id,
+        "traceId": trace_id,
+        "name": obs.get('name', f'{obs_type.lower()}-{obs_id[:8]}'),
+        "startTime": start_time,
+        "metadata": obs['_metadata'],
+    }
+    
+    if end_time:
+        body["endTime"] = end_time
+    
+    if '_input' in obs:
+        body["input"] = obs['_input']
+    
+    if '_output' in obs:
+        body["output"] = obs['_output']
+    
+    if parent_id:
+        body["parentObservationId"] = parent_id
+    
+    if obs_kind == 'GENERATION':
+        if obs.get('model'):
+            body["model"] = obs.get('model')
+        if obs.get('modelParameters'):
+            body["modelParameters"] = obs.get('modelParameters')
+        if obs.get('usage'):
+            body["usage"] = obs.get('usage')
+    
+    if obs.get('level'):
+        body["level"] = obs.get('level')
+    if obs.get('statusMessage'):
+        body["statusMessage"] = obs.get('statusMessage')
+    if obs.get('version'):
+        body["version"] = obs.get('version')
+    
+    return {
+        "id": next(ids),
+        "timestamp": start_time or now_iso,
+        "type": event_type,
+        "body": body
+    }
 
 
 def import_trace_to_langfuse(
@@ -187,157 +367,101 @@ def import_trace_to_langfuse(
     public_key: str,
     secret_key: str,
     host: str,
-    generate_new_ids: bool = True
+    generate_new_ids: bool = True,
+    compress: bool = False
 ) -> str:
     if not observations:
         print("Error: No observations found in file")
         sys.exit(1)
     
-    sorted_obs = sorted(observations, key=lambda x: x.get('depth', 0))
+    # Sort by depth on pre-extracted keys; the index keeps the sort stable
+    # without ever comparing the observation dicts themselves
+    decorated = [(obs.get('depth', 0), i, obs) for i, obs in enumerate(observations)]
+    decorated.sort()
+    sorted_obs = [item[2] for item in decorated]
     id_mapping = {}
     
     root_obs = sorted_obs[0]
     trace_id = root_obs.get('traceId') or root_obs.get('id')
     
+    # Every ID this import can need: the trace, each observation and every event
+    ids = iter(generate_ids(2 * len(sorted_obs) + 2))
+    
     if generate_new_ids:
-        new_trace_id = str(uuid.uuid4())
+        new_trace_id = next(ids)
         id_mapping[trace_id] = new_trace_id
         trace_id = new_trace_id
     
     print(f"Creating trace: {trace_id}")
     
     api_url = f"{host}/api/public/ingestion"
-    headers = {"Content-Type": "application/json"}
     auth = (public_key, secret_key)
     
-    raw_trace_metadata = normalize_tool_call_keys(root_obs.get("metadata", {}))
-    trace_metadata = raw_trace_metadata if isinstance(raw_trace_metadata, dict) else {}
-
-    # Compute start and end time for trace overview
-    all_start_times = [obs.get("startTime") for obs in sorted_obs if obs.get("startTime")]
-    all_end_times = [obs.get("endTime") for obs in sorted_obs if obs.get("endTime")]
-
-    trace_start = min(all_start_times) if all_start_times else datetime.utcnow().isoformat() + "Z"
-    trace_end = max(all_end_times) if all_end_times else trace_start
+    # Fallback timestamp for anything without a start time
+    now_iso = datetime.utcnow().isoformat() + "Z"
+    
+    # The trace event needs every observation prepared, so it is filled in after the loop
+    events = [None]
+    
+    # Earliest start and latest end for the trace overview, tracked during the loop
+    # (ISO-8601 timestamps compare correctly as strings)
+    ts_min = ts_max = None
+    
+    # The last chat-completion provides the trace input/output, also tracked during the loop
+    io_source = None
+    
+    for obs in sorted_obs:
+        # Parse and normalize the observation's payloads once, in the same pass
+        prepare_observation(obs)
+        
+        start_time = obs.get('startTime')
+        end_time = obs.get('endTime')
+        
+        if start_time and (ts_min is None or start_time < ts_min):
+            ts_min = start_time
+        if end_time and (ts_max is None or end_time > ts_max):
+            ts_max = end_time
+        
+        if is_trace_io_source(obs):
+            io_source = obs
+        
+        event = build_event(obs, trace_id, generate_new_ids, id_mapping, now_iso, ids)
+        events.append(event)
+        print(f"  Prepared {obs.get('type', 'SPAN')}: {obs.get('name')} ({event['body']['id'][:8]}...)")
+    
+    trace_start = ts_min or now_iso
+    trace_end = ts_max or trace_start
 
     # Get input/output from last chat-completion
-    merged_input, merged_output = collect_trace_io(sorted_obs)
+    merged_input = io_source.get('_input') if io_source else None
+    merged_output = io_source.get('_output') if io_source else None
 
-    trace_event = {
-        "id": str(uuid.uuid4()),
+    events[0] = {
+        "id": next(ids),
         "timestamp": trace_start,
         "type": "trace-create",
         "body": {
             "id": trace_id,
             "name": root_obs.get("name", "Imported Trace"),
-            "metadata": trace_metadata,
+            "metadata": root_obs['_metadata'],
             "startTime": trace_start,
             "endTime": trace_end,
             "input": merged_input,
             "output": merged_output
         }
     }
-
-    events = [trace_event]
     
-    for obs in sorted_obs:
-        obs_id = obs.get('id')
-        obs_type = obs.get('type', 'SPAN')
-        
-        if generate_new_ids:
-            new_id = str(uuid.uuid4())
-            id_mapping[obs_id] = new_id
-            obs_id = new_id
-        
-        parent_id = obs.get('parentObservationId')
-        if parent_id and generate_new_ids:
-            parent_id = id_mapping.get(parent_id)
-        
-        if obs_type.upper() == 'GENERATION':
-            event_type = "generation-create"
-        elif obs_type.upper() == 'SPAN':
-            event_type = "span-create"
-        elif obs_type.upper() == 'EVENT':
-            event_type = "event-create"
-        else:
-            event_type = "span-create"
-        
-        raw_metadata = normalize_tool_call_keys(obs.get("metadata", {}))
-        metadata = raw_metadata if isinstance(raw_metadata, dict) else {}
-        
-        body = {
-            "id": obs_id,
-            "traceId": trace_id,
-            "name": obs.get('name', f'{obs_type.lower()}-{obs_id[:8]}'),
-            "startTime": obs.get('startTime'),
-            "metadata": metadata,
-        }
-        
-        if obs.get('endTime'):
-            body["endTime"] = obs.get('endTime')
-        
-        if obs.get('input') is not None:
-            # Parse JSON string if needed, then normalize
-            input_data = parse_json_if_string(obs.get('input'))
-            body["input"] = normalize_tool_call_keys(input_data)
-        
-        if obs.get('output') is not None:
-            # Parse JSON string if needed, then normalize
-            output_data = parse_json_if_string(obs.get('output'))
-            # Transform tool_calls format if present
-            output_data = transform_tool_calls_output(output_data)
-            body["output"] = normalize_tool_call_keys(output_data)
-        
-        if parent_id:
-            body["parentObservationId"] = parent_id
-        
-        if obs_type.upper() == 'GENERATION':
-            if obs.get('model'):
-                body["model"] = obs.get('model')
-            if obs.get('modelParameters'):
-                body["modelParameters"] = obs.get('modelParameters')
-            if obs.get('usage'):
-                body["usage"] = obs.get('usage')
-        
-        if obs.get('level'):
-            body["level"] = obs.get('level')
-        if obs.get('statusMessage'):
-            body["statusMessage"] = obs.get('statusMessage')
-        if obs.get('version'):
-            body["version"] = obs.get('version')
-        
-        event = {
-            "id": str(uuid.uuid4()),
-            "timestamp": obs.get('startTime') or datetime.utcnow().isoformat() + "Z",
-            "type": event_type,
-            "body": body
-        }
-        
-        events.append(event)
-        print(f"  Prepared {obs_type}: {obs.get('name')} ({obs_id[:8]}...)")
+    responses = post_events(api_url, events, auth, compress)
     
-    payload = {
-        "batch": events,
-        "metadata": {
-            "batch_size": len(events),
-            "sdk_integration": "trace_importer",
-            "sdk_name": "python",
-            "sdk_version": "custom"
-        }
-    }
-    
-    response = requests.post(
-        api_url,
-        json=payload,
-        headers=headers,
-        auth=auth,
-        timeout=30
-    )
-    
-    print(f"\nAPI Response Status: {response.status_code}")
-    print(f"API Response Body: {response.text[:500]}")
+    failed = False
+    for i, response in enumerate(responses, 1):
+        print(f"\nAPI Response Status (batch {i}/{len(responses)}): {response.status_code}")
+        print(f"API Response Body: {response.text[:500]}")
+        
+        if response.status_code not in [200, 201, 207]:
+            failed = True
     
-    if response.status_code not in [200, 201, 207]:
+    if failed:
         print("✗ Error sending data to Langfuse")
         sys.exit(1)
     
@@ -351,6 +475,7 @@ def main():
     parser.add_argument('--public-key')
     parser.add_argument('--secret-key')
     parser.add_argument('--host', default='https://us.cloud.langfuse.com')
+    parser.add_argument('--gzip', action='store_true', help="Gzip-compress the upload (host must accept Content-Encoding: gzip)")
     
     args = parser.parse_args()
     
@@ -370,7 +495,8 @@ def main():
         public_key,
         secret_key,
         args.host,
-        generate_new_ids=args.new_trace_id
+        generate_new_ids=args.new_trace_id,
+        compress=args.gzip
     )
     
     print(f"\n✓ Successfully imported trace!")